@@ -1,12 +1,16 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from collections import OrderedDict
 from pathlib import Path
+import os
 import sys
 import copy
+import multiprocessing
+import threading
 import json
 import re
 import requests
-import pandas as pd
 
 path = Path().resolve().parent.parent
 sys.path.append(str(path))
@@ -22,9 +26,24 @@ from returnName.nlp.my_token_hf import token_hf
 hugging_face_inference = True
 
 if not hugging_face_inference:
+    import torch
     from transformers import pipeline
 
-model_zero_shot = 'facebook/bart-large-mnli'
+    torch.set_num_threads(int(os.environ.get('OMP_NUM_THREADS', os.cpu_count())))
+    torch.set_num_interop_threads(1)
+
+nlp_fast = os.environ.get('NLP_FAST', '1') != '0'
+nlp_onnx = os.environ.get('NLP_ONNX', '0') == '1'
+nlp_split = os.environ.get('NLP_SPLIT', '0') == '1'
+
+amount_pattern = re.compile(r'(?<![a-zA-Z:])([-+]?\d*\.?\d+)\s*([A-Za-z]*)')
+hypothesis_template = 'This example is {}.'
+request_hint_pattern = re.compile(r'\b(please|can you|could you|move|lower|raise|displace|shift|translate)\b',
+                                  re.IGNORECASE)
+element_name_pattern = re.compile(r'\b[A-Z]\d+\b')
+amount_hint_pattern = re.compile(r'[-+]?\d*\.?\d+\s*(?:m|cm|mm|in|meters|centimeters|millimeters|inches)\b')
+
+model_zero_shot = 'valhalla/distilbart-mnli-12-3' if nlp_fast else 'facebook/bart-large-mnli'
 model_question_answerer = 'distilbert-base-cased-distilled-squad'
 
 
@@ -35,8 +54,8 @@ def query_hf(payload, model_id, api_token):
     return response.json()
 
 
-def query_hf_zero_shot(context, candidate_labels):
-    payload = {'inputs': context, 'parameters': {'candidate_labels': candidate_labels}}
+def query_hf_zero_shot(context, candidate_labels, multi_label=False):
+    payload = {'inputs': context, 'parameters': {'candidate_labels': candidate_labels, 'multi_label': multi_label}}
     return query_hf(payload, model_zero_shot, token_hf)
 
 
@@ -45,33 +64,186 @@ def query_hf_question_answerer(question, context):
     return query_hf(payload, model_question_answerer, token_hf)
 
 
+def init_split_worker(task, model_name):
+    global split_pipeline
+    from transformers import pipeline
+    split_pipeline = pipeline(task, model=model_name)
+    split_pipeline.model.eval()
+
+
+def call_split_worker(args, kwargs):
+    return split_pipeline(*args, **kwargs)
+
+
+class SplitPipeline:
+    def __init__(self, task, model_name):
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(1, initializer=init_split_worker, initargs=(task, model_name))
+
+    def __call__(self, *args, **kwargs):
+        return self.pool.apply(call_split_worker, (args, kwargs))
+
+
 class NLPModels:
+    ZERO_SHOT_MODEL = model_zero_shot
+
+    _lock = threading.Lock()
+
     def __new__(cls):
-        if not hasattr(cls, 'instance'):
-            cls.instance = super(NLPModels, cls).__new__(cls)
-            if not hugging_face_inference:
-                cls.zero_shot = pipeline('zero-shot-classification', model=model_zero_shot)
-                cls.question_answerer = pipeline('question-answering', model=model_question_answerer)
+        with cls._lock:
+            if not hasattr(cls, 'instance'):
+                if not hugging_face_inference:
+                    device = 0 if torch.cuda.is_available() else -1
+                    if nlp_split:
+                        cls.zero_shot = SplitPipeline('zero-shot-classification', cls.ZERO_SHOT_MODEL)
+                        cls.question_answerer = SplitPipeline('question-answering', model_question_answerer)
+                    elif nlp_onnx and device == -1:
+                        cls.zero_shot, cls.question_answerer = cls.build_onnx_pipelines()
+                    else:
+                        torch_dtype = torch.float16 if device == 0 else torch.bfloat16
+                        model_kwargs = {'low_cpu_mem_usage': True}
+                        cls.zero_shot = pipeline('zero-shot-classification', model=cls.ZERO_SHOT_MODEL,
+                                                 device=device, torch_dtype=torch_dtype, model_kwargs=model_kwargs)
+                        cls.question_answerer = pipeline('question-answering', model=model_question_answerer,
+                                                         device=device, torch_dtype=torch_dtype,
+                                                         model_kwargs=model_kwargs)
+                        cls.zero_shot.model.eval()
+                        cls.question_answerer.model.eval()
+                cls.instance = super(NLPModels, cls).__new__(cls)
         return cls.instance
 
+    token_cache_maxsize = 1024
+    token_cache = OrderedDict()
+    _token_lock = threading.Lock()
+
+    def encode_once(self, text):
+        cache = NLPModels.token_cache
+        with NLPModels._token_lock:
+            if text in cache:
+                cache.move_to_end(text)
+                return cache[text]
+        token_ids = self.zero_shot.tokenizer.encode(text, add_special_tokens=False)
+        with NLPModels._token_lock:
+            cache[text] = token_ids
+            if len(cache) > NLPModels.token_cache_maxsize:
+                cache.popitem(last=False)
+        return token_ids
+
+    def zero_shot_prompt_once(self, prompt, candidate_labels, multi_label=False,
+                              hypothesis_template=hypothesis_template):
+        tokenizer = self.zero_shot.tokenizer
+        model = self.zero_shot.model
+        prompt_ids = self.encode_once(prompt)
+        input_ids = [tokenizer.build_inputs_with_special_tokens(
+            prompt_ids, self.encode_once(hypothesis_template.format(label))) for label in candidate_labels]
+        batch = tokenizer.pad({'input_ids': input_ids}, return_tensors='pt').to(model.device)
+        with torch.inference_mode():
+            logits = model(**batch).logits
+        entailment_id = self.zero_shot.entailment_id
+        contradiction_id = -1 if entailment_id == 0 else 0
+        if multi_label or len(candidate_labels) == 1:
+            scores = logits[:, [contradiction_id, entailment_id]].softmax(dim=1)[:, 1]
+        else:
+            scores = logits[:, entailment_id].softmax(dim=0)
+        scores = scores.tolist()
+        order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+        return {'sequence': prompt,
+                'labels': [candidate_labels[i] for i in order],
+                'scores': [scores[i] for i in order]}
+
+    @staticmethod
+    def load_quantized_onnx(model_cls, model_name):
+        from optimum.onnxruntime import ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        save_dir = Path.home() / '.cache' / 'returnName' / model_name.replace('/', '--')
+        if not (save_dir / 'model_quantized.onnx').exists():
+            model_cls.from_pretrained(model_name, export=True).save_pretrained(save_dir)
+            quantizer = ORTQuantizer.from_pretrained(save_dir)
+            quantizer.quantize(save_dir=save_dir,
+                               quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False))
+        return model_cls.from_pretrained(save_dir, file_name='model_quantized.onnx')
+
+    @classmethod
+    def build_onnx_pipelines(cls):
+        from optimum.onnxruntime import ORTModelForQuestionAnswering, ORTModelForSequenceClassification
+        zero_shot = pipeline('zero-shot-classification',
+                             model=cls.load_quantized_onnx(ORTModelForSequenceClassification, cls.ZERO_SHOT_MODEL),
+                             tokenizer=cls.ZERO_SHOT_MODEL)
+        question_answerer = pipeline('question-answering',
+                                     model=cls.load_quantized_onnx(ORTModelForQuestionAnswering,
+                                                                   model_question_answerer),
+                                     tokenizer=model_question_answerer)
+        return zero_shot, question_answerer
+
+
+if not hugging_face_inference and not nlp_split:
+    threading.Thread(target=NLPModels, daemon=True).start()
+
 
 @dataclass
 class NLPModelsHelper:
     zero_shot_threshold: float = 0.6
 
+    cache_maxsize = 1024
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
     def __post_init__(self):
         self.nlp_models = NLPModels()
 
+    @staticmethod
+    def _run_inference(func, *args, **kwargs):
+        if hugging_face_inference:
+            return func(*args, **kwargs)
+        with torch.inference_mode():
+            return func(*args, **kwargs)
+
+    @staticmethod
+    def valid_response(value):
+        return isinstance(value, dict) and 'error' not in value
+
+    def _cached_call(self, key, func, *args, **kwargs):
+        cache = NLPModelsHelper._cache
+        with NLPModelsHelper._cache_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        value = self._run_inference(func, *args, **kwargs)
+        if self.valid_response(value):
+            with NLPModelsHelper._cache_lock:
+                cache[key] = value
+                if len(cache) > self.cache_maxsize:
+                    cache.popitem(last=False)
+        return value
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    def zero_shot_raw(self, prompt, candidate_labels, multi_label=False):
+        key = ('zero_shot', prompt, tuple(candidate_labels), multi_label)
+        if hugging_face_inference or nlp_split or nlp_onnx:
+            return self._cached_call(key, self.nlp_models.zero_shot, prompt,
+                                     candidate_labels=list(candidate_labels), multi_label=multi_label)
+        return self._cached_call(key, self.nlp_models.zero_shot_prompt_once, prompt,
+                                 list(candidate_labels), multi_label=multi_label)
+
     def zero_shot(self, prompt, candidate_label):
-        return (self.nlp_models.zero_shot(prompt, candidate_labels=[candidate_label])['scores'][0]
-                > self.zero_shot_threshold)
+        return self.zero_shot_any(prompt, [candidate_label])
+
+    def zero_shot_any(self, prompt, candidate_labels):
+        output = self.zero_shot_raw(prompt, candidate_labels, multi_label=True)
+        return max(output['scores']) > self.zero_shot_threshold
 
     def zero_shot_multiple(self, prompt, candidate_labels):
-        df = pd.DataFrame(self.nlp_models.zero_shot(prompt, candidate_labels=candidate_labels))
-        return df.iloc[df['scores'].idxmax()]['labels']
+        output = self.zero_shot_raw(prompt, candidate_labels)
+        best = max(range(len(output['scores'])), key=output['scores'].__getitem__)
+        return output['labels'][best]
 
     def question_answerer(self, question, context):
-        return self.nlp_models.question_answerer(question=question, context=context)['answer']
+        key = ('question_answerer', question, context)
+        return self._cached_call(key, self.nlp_models.question_answerer, question=question, context=context)['answer']
 
 
 class BotMessages:
@@ -131,10 +303,11 @@ class NLPField(NLPModelsHelper):
         super().__post_init__()
         self.directions = ['up', 'down', 'front', 'back', 'left', 'right']
         self.other_names = [] if self.other_names is None else self.other_names
+        self.nlp_recipe = self.setup_nlp_recipe()
+        self.nlp_recipe_stages = self.setup_nlp_recipe_stages()
 
-    @property
-    def nlp_recipe(self):
-        return OrderedDict({
+    def setup_nlp_recipe(self):
+        return {
             'element': {
                 'func': self.which_element,
                 'args': 'prompt'
@@ -160,7 +333,26 @@ class NLPField(NLPModelsHelper):
                 'args': 'amount',
                 'readable_value_name': 'amount'
             }
-        })
+        }
+
+    def setup_nlp_recipe_stages(self):
+        recipe = self.nlp_recipe
+        available = {'prompt'}
+        pending = list(recipe.keys())
+        stages = []
+        while pending:
+            stage = []
+            for step_name in pending:
+                args = recipe[step_name]['args'] if 'args' in recipe[step_name] else []
+                args = args if isinstance(args, list) else [args]
+                if all(arg in available for arg in args):
+                    stage.append(step_name)
+            if len(stage) == 0:
+                break
+            stages.append(stage)
+            available.update(stage)
+            pending = [step_name for step_name in pending if step_name not in stage]
+        return stages
 
     @property
     def parsed_items_to_discard(self):
@@ -170,23 +362,27 @@ class NLPField(NLPModelsHelper):
     def all_field_names(self):
         return [self.name] if len(self.other_names) == 0 else self.other_names
 
+    def warm_token_cache(self):
+        if hugging_face_inference or nlp_split or nlp_onnx:
+            return
+        labels = [self.name, *self.other_names, *self.directions, *getattr(self, 'elements', []), 'request', 'number']
+        for label in labels:
+            self.nlp_models.encode_once(hypothesis_template.format(label))
+
     def belongs(self, name):
         return True if name in self.all_field_names else False
 
     def found_inside(self, prompt):
-        if self.zero_shot(prompt, self.name):
-            return True
-        else:
-            for name in self.other_names:
-                if self.zero_shot(prompt, name):
-                    return True
-            return False
+        return self.zero_shot_any(prompt, [self.name, *self.other_names])
 
     def which_element(self, prompt):
         candidate = self.zero_shot_multiple(prompt, self.elements)
         return candidate if self.zero_shot(prompt, candidate) else None
 
     def element_name(self, prompt, element):
+        matches = element_name_pattern.findall(prompt)
+        if len(matches) == 1:
+            return matches[0]
         question = f'Which is the name of the {element}?'
         name = self.question_answerer(question, prompt)
         return None if name == '' else name.split()[0]
@@ -199,13 +395,15 @@ class NLPField(NLPModelsHelper):
         return self.zero_shot_multiple(prompt, self.directions)
 
     def amount(self, prompt):
+        matches = amount_hint_pattern.findall(prompt)
+        if len(matches) == 1:
+            return matches[0]
         question = f'By how much?'
         return self.question_answerer(question, prompt)
 
     def amount_breakdown(self, amount):
-        numbers = re.findall(r'(?<![a-zA-Z:])[-+]?\d*\.?\d+', amount)
-        unit = None
-        if len(numbers) == 0:
+        match = amount_pattern.search(amount)
+        if match is None:
             elements = amount.split()
             number_found = False
             for element in elements:
@@ -219,9 +417,7 @@ class NLPField(NLPModelsHelper):
                 return None
             unit = elements[-1]
         else:
-            number = numbers[0]
-        if unit is None:
-            unit = ''.join([letter for letter in amount if letter.isalnum() and not letter.isdigit()])
+            number, unit = match.groups()
             unit = 'm' if unit == '' else unit  # defaulting to meters
         unit_names_short = ['m', 'cm', 'mm', 'in']
         unit_names_long = ['meters', 'centimeters', 'millimeters', 'inches']
@@ -286,23 +482,33 @@ class NLPField(NLPModelsHelper):
         value = func(*args)
         if value is None:
             value_name = value_name if readable_value_name is None else readable_value_name
-            return {**parsed_items, **{'answer': self.on_fail(value_name, parsed_items)}}
+            parsed_items['answer'] = self.on_fail(value_name, parsed_items)
+            return parsed_items
         parsed_items[value_name] = value
         return parsed_items
 
-    def process_prompt(self, prompt, user_name=None):
-        parsed_items = {'success': False, 'prompt': prompt}
-        for step_name, step_data in self.nlp_recipe.items():
+    def process_stage(self, stage, parsed_items):
+        for step_name in stage:
+            step_data = self.nlp_recipe[step_name]
             func = step_data['func']
             args = step_data['args'] if 'args' in step_data else []
             readable_value_name = step_data['readable_value_name'] if 'readable_value_name' in step_data else None
             parsed_items = self.process_one_step(step_name, parsed_items, func, args, readable_value_name)
             if step_name not in parsed_items:
+                return parsed_items
+        return parsed_items
+
+    def process_prompt(self, prompt, user_name=None):
+        parsed_items = {'success': False, 'prompt': prompt}
+        for stage in self.nlp_recipe_stages:
+            parsed_items = self.process_stage(stage, parsed_items)
+            if any(step_name not in parsed_items for step_name in stage):
                 return self.discard_items(parsed_items)
         parsed_items['success'] = True
         parsed_items = self.parse_amount(parsed_items)
         parsed_items = self.discard_items(parsed_items)
-        return {**parsed_items, **{'answer': self.on_success(parsed_items, user_name=user_name)}}
+        parsed_items['answer'] = self.on_success(parsed_items, user_name=user_name)
+        return parsed_items
 
 
 @dataclass
@@ -312,6 +518,7 @@ class NLPStructuralField(NLPField):
         self.name = 'structural'
         self.elements = ['wall', 'slab', 'beam', 'column']
         self.other_names = ['structural', *self.elements]
+        self.warm_token_cache()
 
 
 @dataclass
@@ -321,6 +528,7 @@ class NLPMepField(NLPField):
         self.name = 'MEP'
         self.other_names = ['mechanical', 'electrical', 'plumbing', 'fire protection']
         self.elements = ['duct', 'pipe', 'tray']
+        self.warm_token_cache()
 
 
 @dataclass
@@ -330,8 +538,8 @@ class NLPAgent(NLPModelsHelper, BotMessages):
     connection: ... = None
 
     def __post_init__(self):
+        super().__post_init__()
         self.fields = self.setup_fields()
-        self.nlp_models = NLPModels()
         if hugging_face_inference:
             self.nlp_models.zero_shot = query_hf_zero_shot
             self.nlp_models.question_answerer = query_hf_question_answerer
@@ -402,9 +610,17 @@ class NLPAgent(NLPModelsHelper, BotMessages):
                 return field
         return None
 
+    def detect_field(self, prompt):
+        with ThreadPoolExecutor(max_workers=len(self.fields)) as executor:
+            found = list(executor.map(lambda field: field.found_inside(prompt), self.fields))
+        for field, found_inside in zip(self.fields, found):
+            if found_inside:
+                return field.name
+        return self.which_field(self.zero_shot_multiple(prompt, self.all_field_names))
+
     def process_prompt(self, prompt, user_name=None, channel_id=None):
         user_txt = '' if user_name is None else f' @{user_name}'
-        if not self.zero_shot(prompt, candidate_label='request'):
+        if request_hint_pattern.search(prompt) is None and not self.zero_shot(prompt, candidate_label='request'):
             return {'success': False, 'answer': self.message_not_request(user_txt)}
         if 'stream' in prompt.lower():
             stream_id = self.question_answerer('what is the stream id?', prompt)
@@ -415,11 +631,23 @@ class NLPAgent(NLPModelsHelper, BotMessages):
                 return {'success': False, 'answer': self.message_linking_stream(user_txt, stream_id)}
             elif channel_id not in self.channel_streams:
                 return {'success': False, 'answer': self.message_not_request(user_txt)}
-        related_field = self.zero_shot_multiple(prompt, self.all_field_names)
-        related_field = self.which_field(related_field)
+        related_field = self.detect_field(prompt)
         field = self.field_by_name(related_field)
         return {**{'field': related_field}, **field.process_prompt(prompt, user_name=user_name)}
 
+    async def aprocess_prompt(self, prompt, user_name=None, channel_id=None):
+        return await asyncio.to_thread(self.process_prompt, prompt, user_name=user_name, channel_id=channel_id)
+
+    async def apush_prompt(self, user, prompt, channel_id, debug=False):
+        return await asyncio.to_thread(self.push_prompt, user, prompt, channel_id, debug)
+
+    def process_prompts(self, prompts, user_name=None, channel_id=None):
+        if len(prompts) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(prompts), 8)) as executor:
+            return list(executor.map(
+                lambda prompt: self.process_prompt(prompt, user_name=user_name, channel_id=channel_id), prompts))
+
     def push_prompt(self, user, prompt, channel_id, debug=False):
         user_txt = '' if user is None else f' @{user}'
         if prompt.lower() == 'hello':
@@ -476,8 +704,7 @@ if __name__ == '__main__':
     ]
 
     nlp_agent = NLPAgent()
-    for query in queries:
-        request_data = nlp_agent.process_prompt(query)
+    for request_data in nlp_agent.process_prompts(queries):
         print(request_data)
 
     # nlp_agent.push_prompt('carlos', 'hey, can you set this channel to stream 8e6d1d1c53', '123456')